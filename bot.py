@@ -5,6 +5,9 @@ from datetime import datetime, timedelta
 import json
 import threading
 import time
+import functools
+from collections import OrderedDict
+from typing import Optional
 from telebot import types
 import weather_app
 
@@ -37,6 +40,181 @@ def get_user(user_id: int) -> dict:
     return USERS[user_id]
 
 
+# ==========================
+# Conversation state storage
+# ==========================
+# Pending dialog step per user instead of bot.register_next_step_handler:
+# entries expire after DIALOG_TTL seconds and the oldest are evicted
+# once DIALOG_MAX_ENTRIES is reached.
+# user_id -> {"state": str, "expires_at": float}
+DIALOG_TTL = int(os.getenv("DIALOG_TTL", 10 * 60))
+DIALOG_MAX_ENTRIES = int(os.getenv("DIALOG_MAX_ENTRIES", 10000))
+DIALOGS = OrderedDict()
+DIALOGS_LOCK = threading.Lock()
+
+STATE_CITY_WEATHER = "city_weather"
+STATE_COMPARE = "compare"
+STATE_ADVANCED = "advanced"
+
+
+def _purge_dialogs(now: float):
+    # entries share one TTL, so the oldest ones are always at the front
+    while DIALOGS:
+        entry = next(iter(DIALOGS.values()))
+        if entry["expires_at"] > now and len(DIALOGS) <= DIALOG_MAX_ENTRIES:
+            break
+        DIALOGS.popitem(last=False)
+
+
+def set_dialog_state(user_id: int, state: str):
+    now = time.time()
+    with DIALOGS_LOCK:
+        DIALOGS.pop(user_id, None)
+        DIALOGS[user_id] = {"state": state, "expires_at": now + DIALOG_TTL}
+        _purge_dialogs(now)
+
+
+def get_dialog_state(user_id: int) -> Optional[str]:
+    with DIALOGS_LOCK:
+        entry = DIALOGS.get(user_id)
+        if not entry:
+            return None
+        if entry["expires_at"] <= time.time():
+            del DIALOGS[user_id]
+            return None
+        return entry["state"]
+
+
+def pop_dialog_state(user_id: int) -> Optional[str]:
+    with DIALOGS_LOCK:
+        entry = DIALOGS.pop(user_id, None)
+    if not entry or entry["expires_at"] <= time.time():
+        return None
+    return entry["state"]
+
+
+def clear_dialog_state(user_id: int):
+    with DIALOGS_LOCK:
+        DIALOGS.pop(user_id, None)
+
+
+# ==========================
+# Inbound request control
+# ==========================
+# Every handler goes through inbound_guard: a message or callback identical to
+# one still being handled for the same user, or to the user's previous request
+# finished less than INBOUND_DEDUP_WINDOW seconds ago, is dropped; each user
+# gets a token bucket of INBOUND_RATE_LIMIT requests per INBOUND_RATE_PERIOD
+# seconds.
+INBOUND_DEDUP_WINDOW = float(os.getenv("INBOUND_DEDUP_WINDOW", 2))
+INBOUND_RATE_LIMIT = int(os.getenv("INBOUND_RATE_LIMIT", 20))
+INBOUND_RATE_PERIOD = float(os.getenv("INBOUND_RATE_PERIOD", 60))
+INBOUND_MAX_USERS = int(os.getenv("INBOUND_MAX_USERS", 10000))
+# user_id -> {"tokens": float, "updated": float, "last_key": tuple|None,
+#             "last_finished_at": float|None, "in_flight": set, "warned": bool}
+INBOUND = OrderedDict()
+INBOUND_LOCK = threading.Lock()
+
+INBOUND_DUPLICATE = "duplicate"
+INBOUND_RATE_LIMITED = "rate_limited"
+INBOUND_THROTTLED = "throttled"
+
+
+def _inbound_entry(user_id: int, now: float) -> dict:
+    # caller holds INBOUND_LOCK; least recently active users are evicted first
+    entry = INBOUND.pop(user_id, None)
+    if entry is None:
+        entry = {"tokens": float(INBOUND_RATE_LIMIT), "updated": now, "last_key": None,
+                 "last_finished_at": None, "in_flight": set(), "warned": False}
+    INBOUND[user_id] = entry
+    while len(INBOUND) > INBOUND_MAX_USERS:
+        INBOUND.popitem(last=False)
+    return entry
+
+
+def acquire_inbound(user_id: int, key: tuple) -> Optional[str]:
+    """Return None if the request may run, otherwise the reason it is dropped"""
+    now = time.time()
+    with INBOUND_LOCK:
+        entry = _inbound_entry(user_id, now)
+        if key in entry["in_flight"]:
+            return INBOUND_DUPLICATE
+        finished_at = entry["last_finished_at"]
+        if key == entry["last_key"] and finished_at is not None and now - finished_at <= INBOUND_DEDUP_WINDOW:
+            return INBOUND_DUPLICATE
+        refill = (now - entry["updated"]) * INBOUND_RATE_LIMIT / INBOUND_RATE_PERIOD
+        entry["tokens"] = min(float(INBOUND_RATE_LIMIT), entry["tokens"] + refill)
+        entry["updated"] = now
+        if entry["tokens"] < 1:
+            if entry["warned"]:
+                return INBOUND_THROTTLED
+            entry["warned"] = True
+            return INBOUND_RATE_LIMITED
+        entry["tokens"] -= 1
+        entry["warned"] = False
+        entry["in_flight"].add(key)
+        entry["last_key"] = key
+        entry["last_finished_at"] = None
+        return None
+
+
+def release_inbound(user_id: int, key: tuple):
+    with INBOUND_LOCK:
+        entry = INBOUND.get(user_id)
+        if entry:
+            entry["in_flight"].discard(key)
+            if entry["last_key"] == key:
+                entry["last_finished_at"] = time.time()
+
+
+def inbound_key(update) -> tuple:
+    if isinstance(update, types.CallbackQuery):
+        message_id = update.message.message_id if update.message else None
+        return ("callback", message_id, update.data)
+    if update.location:
+        return ("location", update.location.latitude, update.location.longitude)
+    return ("message", update.text)
+
+
+def inbound_guard(handler):
+    @functools.wraps(handler)
+    def wrapper(update):
+        user_id = update.from_user.id
+        key = inbound_key(update)
+        verdict = acquire_inbound(user_id, key)
+        if verdict is None:
+            try:
+                return handler(update)
+            finally:
+                release_inbound(user_id, key)
+        warning = "Слишком много запросов, подождите немного." if verdict == INBOUND_RATE_LIMITED else None
+        try:
+            if isinstance(update, types.CallbackQuery):
+                # always answer so the button stops spinning
+                bot.answer_callback_query(update.id, warning)
+            elif warning:
+                bot.send_message(update.chat.id, warning)
+        except Exception:
+            pass
+    return wrapper
+
+
+def edit_inline_text(call: types.CallbackQuery, text: str, reply_markup: types.InlineKeyboardMarkup):
+    """Edit the callback's message, skipping edits that would not change it"""
+    if call.message.text == text:
+        return
+    try:
+        bot.edit_message_text(
+            text,
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            reply_markup=reply_markup
+        )
+    except telebot.apihelper.ApiTelegramException as e:
+        if "message is not modified" not in str(e):
+            raise
+
+
 def main_menu_keyboard() -> types.ReplyKeyboardMarkup:
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.row(
@@ -55,8 +233,10 @@ def main_menu_keyboard() -> types.ReplyKeyboardMarkup:
 
 
 @bot.message_handler(commands=["start", "help"])
+@inbound_guard
 def on_start(message: types.Message):
     user = get_user(message.from_user.id)
+    clear_dialog_state(message.from_user.id)
     bot.send_message(
         message.chat.id,
         "Привет! Я погодный бот. Выберите действие:",
@@ -69,9 +249,10 @@ def on_start(message: types.Message):
 # ==========================
 
 @bot.message_handler(func=lambda m: m.text == "🌆 Погода по городу")
+@inbound_guard
 def ask_city_weather(message: types.Message):
     bot.send_message(message.chat.id, "Введите название города (например: Москва):")
-    bot.register_next_step_handler(message, handle_city_weather_input)
+    set_dialog_state(message.from_user.id, STATE_CITY_WEATHER)
 
 
 def format_current_weather(data: dict) -> str:
@@ -110,7 +291,15 @@ def handle_city_weather_input(message: types.Message):
     if not city:
         bot.send_message(message.chat.id, "Пустое название города. Отменено.")
         return
-    data = weather_app.get_current_weather(city=city)
+    coordinates = weather_app.get_coordinates(city)
+    if not coordinates:
+        text = f"Город «{city}» не найден."
+        suggestions = weather_app.suggest_cities(city)
+        if suggestions:
+            text += "\nВозможно, вы имели в виду: " + ", ".join(suggestions)
+        bot.send_message(message.chat.id, text, reply_markup=main_menu_keyboard())
+        return
+    data = weather_app.get_current_weather(latitude=coordinates[0], longitude=coordinates[1])
     if data and "coord" in data:
         user = get_user(message.from_user.id)
         user["city"] = city
@@ -124,8 +313,10 @@ def handle_city_weather_input(message: types.Message):
 # =====================================
 
 @bot.message_handler(func=lambda m: m.text == "🗓 Прогноз на 5 дней")
+@inbound_guard
 def show_forecast_days(message: types.Message):
     user = get_user(message.from_user.id)
+    clear_dialog_state(message.from_user.id)
     if not user.get("lat") or not user.get("lon"):
         bot.send_message(message.chat.id, "Сначала отправьте геолокацию или запросите погоду по городу, чтобы сохранить место.")
         return
@@ -196,32 +387,24 @@ def send_forecast_days_inline(chat_id: int, user_id: int, lat: float, lon: float
 
 
 @bot.callback_query_handler(func=lambda c: c.data and (c.data.startswith("day:") or c.data == "back:days"))
+@inbound_guard
 def on_forecast_callback(call: types.CallbackQuery):
     user = get_user(call.from_user.id)
+    clear_dialog_state(call.from_user.id)
     cache = user.get("forecast_cache") or {}
     data = cache.get("data")
     days = cache.get("days") or {}
     if call.data.startswith("day:"):
         day = call.data.split(":", 1)[1]
         text = format_day_details(day, days.get(day, []))
-        bot.edit_message_text(
-            text,
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            reply_markup=build_day_details_keyboard(day)
-        )
+        edit_inline_text(call, text, build_day_details_keyboard(day))
     else:
         # back to days list
         days_keys = sorted(days.keys())[:5]
         text = "Выберите день для подробностей:\n" + "\n".join(
             [f"• {datetime.strptime(d, '%Y-%m-%d').strftime('%a %d.%m')}: {day_summary(days[d])}" for d in days_keys]
         )
-        bot.edit_message_text(
-            text,
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            reply_markup=build_days_keyboard(days_keys)
-        )
+        edit_inline_text(call, text, build_days_keyboard(days_keys))
     bot.answer_callback_query(call.id)
 
 
@@ -230,18 +413,26 @@ def on_forecast_callback(call: types.CallbackQuery):
 # =============================================
 
 @bot.message_handler(content_types=["location"])
+@inbound_guard
 def on_location(message: types.Message):
     if not message.location:
         return
     user = get_user(message.from_user.id)
     user["lat"] = message.location.latitude
     user["lon"] = message.location.longitude
+    # a location is a valid reply to the advanced data prompt; any other
+    # pending dialog is abandoned
+    if pop_dialog_state(message.from_user.id) == STATE_ADVANCED:
+        handle_advanced_input(message)
+        return
     data = weather_app.get_current_weather(latitude=user["lat"], longitude=user["lon"])
     bot.send_message(message.chat.id, "Местоположение сохранено. Текущая погода:\n\n" + format_current_weather(data), reply_markup=main_menu_keyboard())
 
 
 @bot.message_handler(func=lambda m: m.text == "📍 Отправить геолокацию")
+@inbound_guard
 def ask_geo(message: types.Message):
+    clear_dialog_state(message.from_user.id)
     bot.send_message(message.chat.id, "Нажмите кнопку '📍 Отправить геолокацию' ниже, чтобы поделиться местоположением.")
 
 
@@ -250,8 +441,10 @@ def ask_geo(message: types.Message):
 # =============================================
 
 @bot.message_handler(func=lambda m: m.text == "🔔 Уведомления")
+@inbound_guard
 def toggle_notifications(message: types.Message):
     user = get_user(message.from_user.id)
+    clear_dialog_state(message.from_user.id)
     kb = types.InlineKeyboardMarkup()
     kb.add(
         types.InlineKeyboardButton(text="Включить", callback_data="notif:on"),
@@ -262,8 +455,10 @@ def toggle_notifications(message: types.Message):
 
 
 @bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("notif:"))
+@inbound_guard
 def on_notif_toggle(call: types.CallbackQuery):
     user = get_user(call.from_user.id)
+    clear_dialog_state(call.from_user.id)
     action = call.data.split(":", 1)[1]
     if action == "on":
         user["notify"] = True
@@ -328,9 +523,10 @@ def scheduler_loop():
 # =============================================
 
 @bot.message_handler(func=lambda m: m.text == "⚖️ Сравнить города")
+@inbound_guard
 def ask_compare(message: types.Message):
     bot.send_message(message.chat.id, "Введите два города через запятую (например: Москва, Санкт-Петербург):")
-    bot.register_next_step_handler(message, handle_compare_input)
+    set_dialog_state(message.from_user.id, STATE_COMPARE)
 
 
 def handle_compare_input(message: types.Message):
@@ -357,9 +553,10 @@ def handle_compare_input(message: types.Message):
 # =============================================
 
 @bot.message_handler(func=lambda m: m.text == "🧭 Расширенные данные")
+@inbound_guard
 def ask_advanced(message: types.Message):
     bot.send_message(message.chat.id, "Введите город ИЛИ отправьте геолокацию заранее, и я покажу расширенные данные.")
-    bot.register_next_step_handler(message, handle_advanced_input)
+    set_dialog_state(message.from_user.id, STATE_ADVANCED)
 
 
 def handle_advanced_input(message: types.Message):
@@ -411,13 +608,40 @@ def handle_advanced_input(message: types.Message):
     bot.send_message(message.chat.id, text_out, reply_markup=main_menu_keyboard())
 
 
+# =============================================
+# 7) Dialog input (city / compare / advanced)
+# =============================================
+
+DIALOG_HANDLERS = {
+    STATE_CITY_WEATHER: handle_city_weather_input,
+    STATE_COMPARE: handle_compare_input,
+    STATE_ADVANCED: handle_advanced_input,
+}
+
+
+@bot.message_handler(func=lambda m: get_dialog_state(m.from_user.id) is not None, content_types=["text"])
+@inbound_guard
+def on_dialog_input(message: types.Message):
+    handler = DIALOG_HANDLERS.get(pop_dialog_state(message.from_user.id))
+    if handler is None:
+        # dialog expired between the filter and the handler
+        send_menu_hint(message.chat.id)
+        return
+    handler(message)
+
+
 # ================
 # Fallback handler
 # ================
 
 @bot.message_handler(func=lambda m: True, content_types=["text"])
+@inbound_guard
 def fallback(message: types.Message):
-    bot.send_message(message.chat.id, "Выберите действие из меню ниже.", reply_markup=main_menu_keyboard())
+    send_menu_hint(message.chat.id)
+
+
+def send_menu_hint(chat_id: int):
+    bot.send_message(chat_id, "Выберите действие из меню ниже.", reply_markup=main_menu_keyboard())
 
 
 def run_bot():
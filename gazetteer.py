@@ -0,0 +1,178 @@
+import os
+import difflib
+import threading
+from typing import Dict, List, Tuple, Optional
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CITIES_PATH = os.getenv("CITIES_PATH", os.path.join(BASE_DIR, "cities.tsv"))
+LEARNED_CITIES_PATH = os.getenv("LEARNED_CITIES_PATH", os.path.join(BASE_DIR, "learned_cities.tsv"))
+# Сколько названий можно запомнить из сетевого геокодирования
+LEARNED_CITIES_MAX = int(os.getenv("LEARNED_CITIES_MAX", 5000))
+
+# Кириллица -> латиница, чтобы "Москва" и "Moskva" давали один ключ
+TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e",
+    "ж": "zh", "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+    "і": "i", "ї": "i", "є": "e",
+}
+
+# Варианты латинского написания, которые сводим к одному
+LATIN_VARIANTS = [("kh", "h"), ("y", "i"), ("j", "i"), ("w", "v")]
+
+_END = "$"
+
+
+def normalize_city(name: str) -> str:
+    """Приводит название города к ключу индекса: регистр, ё, дефисы, транслит"""
+    text = (name or "").casefold().replace("-", " ").replace(".", " ")
+    text = "".join(TRANSLIT.get(ch, ch) for ch in text)
+    for src, dst in LATIN_VARIANTS:
+        text = text.replace(src, dst)
+    return " ".join(text.split())
+
+
+class Gazetteer:
+    """Локальный индекс городов: точный поиск, поиск по префиксу и нечеткий"""
+
+    def __init__(self):
+        # (отображаемое имя, lat, lon)
+        self._entries: List[Tuple[str, float, float]] = []
+        self._exact: Dict[str, int] = {}
+        self._trie: Dict = {}
+        self._lock = threading.Lock()
+        self.learned = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, name: str, latitude: float, longitude: float, aliases: List[str] = ()) -> bool:
+        """Добавляет город; возвращает False, если все его названия уже известны"""
+        with self._lock:
+            return self._add_locked(name, latitude, longitude, aliases)
+
+    def _add_locked(self, name: str, latitude: float, longitude: float, aliases: List[str]) -> bool:
+        # caller holds self._lock
+        keys = [k for k in (normalize_city(n) for n in [name, *aliases]) if k]
+        keys = [k for k in dict.fromkeys(keys) if k not in self._exact]
+        if not keys:
+            return False
+        entry_id = len(self._entries)
+        self._entries.append((name, latitude, longitude))
+        for key in keys:
+            self._exact[key] = entry_id
+            node = self._trie
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node.setdefault(_END, []).append(entry_id)
+        return True
+
+    def load(self, path: str) -> int:
+        """Загружает TSV (name, aliases, lat, lon); возвращает число строк"""
+        if not os.path.exists(path):
+            return 0
+        loaded = 0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\r\n")
+                if not line or line.startswith("#"):
+                    continue
+                parts = line.split("\t")
+                if len(parts) != 4:
+                    continue
+                name, aliases, lat, lon = parts
+                try:
+                    lat, lon = float(lat), float(lon)
+                except ValueError:
+                    continue
+                self.add(name, lat, lon, [a for a in aliases.split("|") if a])
+                loaded += 1
+        return loaded
+
+    def _prefix_ids(self, key: str, limit: int) -> List[int]:
+        # caller holds self._lock
+        node = self._trie
+        for ch in key:
+            node = node.get(ch)
+            if node is None:
+                return []
+        found = []
+        stack = [node]
+        while stack and len(found) < limit:
+            node = stack.pop()
+            for entry_id in node.get(_END, []):
+                if entry_id not in found:
+                    found.append(entry_id)
+            stack.extend(child for ch, child in sorted(node.items(), reverse=True) if ch != _END)
+        return found[:limit]
+
+    def lookup(self, query: str) -> Optional[Tuple[float, float]]:
+        """Координаты только по точному совпадению названия или синонима, иначе None"""
+        key = normalize_city(query)
+        if not key:
+            return None
+        with self._lock:
+            entry_id = self._exact.get(key)
+            if entry_id is None:
+                return None
+            _, lat, lon = self._entries[entry_id]
+        return lat, lon
+
+    def suggest(self, query: str, limit: int = 5) -> List[str]:
+        """Подсказки для опечаток: сначала по префиксу, затем нечеткие совпадения"""
+        key = normalize_city(query)
+        if not key:
+            return []
+        with self._lock:
+            ids = self._prefix_ids(key, limit)
+            for close in difflib.get_close_matches(key, list(self._exact), n=limit, cutoff=0.7):
+                entry_id = self._exact[close]
+                if entry_id not in ids:
+                    ids.append(entry_id)
+            return [self._entries[i][0] for i in ids[:limit]]
+
+    def learn(self, name: str, latitude: float, longitude: float, aliases: List[str] = (),
+              path: str = None) -> None:
+        """Запоминает результат сетевого геокодирования и дописывает его в файл.
+
+        name - каноническое название из ответа API (его показываем в подсказках),
+        aliases - запрос пользователя и локализованные названия.
+        """
+        def clean(text: str) -> str:
+            return " ".join((text or "").replace("|", " ").split())
+
+        name = clean(name)
+        aliases = [a for a in (clean(a) for a in aliases) if a]
+        if not name:
+            return
+        path = path or LEARNED_CITIES_PATH
+        with self._lock:
+            if self.learned >= LEARNED_CITIES_MAX:
+                return
+            if not self._add_locked(name, latitude, longitude, aliases):
+                return
+            self.learned += 1
+            try:
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(f"{name}\t{'|'.join(aliases)}\t{latitude}\t{longitude}\n")
+            except OSError as e:
+                print(f"Failed to save learned city {name}: {e}")
+
+
+_GAZETTEER = None
+_GAZETTEER_LOCK = threading.Lock()
+
+
+def get_gazetteer() -> Gazetteer:
+    """Возвращает общий индекс, загружая его при первом обращении"""
+    global _GAZETTEER
+    if _GAZETTEER is None:
+        with _GAZETTEER_LOCK:
+            if _GAZETTEER is None:
+                gazetteer = Gazetteer()
+                gazetteer.load(CITIES_PATH)
+                gazetteer.learned = gazetteer.load(LEARNED_CITIES_PATH)
+                _GAZETTEER = gazetteer
+    return _GAZETTEER
@@ -1,8 +1,18 @@
 import requests
 from dotenv import load_dotenv
 import os
-from typing import Dict, List, Tuple, Optional
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Tuple, Optional, Iterator
 from colorama import init, Fore, Style
+import gazetteer
 
 init(autoreset=True)
 
@@ -12,7 +22,10 @@ API_KEY = os.getenv("API_KEY")
 def get_current_weather(city: str=None, latitude: float=None, longitude: float=None) -> dict:
     if city:
         print(f"Getting weather for {city}")
-        latitude, longitude = get_coordinates(city)
+        coordinates = get_coordinates(city)
+        if not coordinates:
+            return None
+        latitude, longitude = coordinates
         weather = get_weather_by_coordinates(latitude, longitude)
         return weather
 
@@ -21,16 +34,42 @@ def get_current_weather(city: str=None, latitude: float=None, longitude: float=N
         return get_weather_by_coordinates(latitude, longitude)
 
 def get_coordinates(city: str) -> tuple:
-    url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&appid={API_KEY}"
-    response = requests.get(url)
+    """Ищет координаты в локальном индексе городов, при промахе - через геокодер API"""
+    index = gazetteer.get_gazetteer()
+    coordinates = index.lookup(city)
+    if coordinates:
+        return coordinates
+    url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={API_KEY}"
+    try:
+        response = requests.get(url, timeout=10)
+    except requests.RequestException as e:
+        print(f"Error in get_coordinates: {e}")
+        return None
     if response.status_code != 200:
         print(f"Failed to get coordinates for {city}")
         return None
-    return response.json()[0]["lat"], response.json()[0]["lon"]
+    results = response.json()
+    if not results:
+        print(f"City not found: {city}")
+        return None
+    place = results[0]
+    latitude, longitude = place["lat"], place["lon"]
+    local_names = place.get("local_names") or {}
+    aliases = [city, local_names.get("ru"), local_names.get("en")]
+    index.learn(place.get("name") or city, latitude, longitude, [a for a in aliases if a])
+    return latitude, longitude
+
+def suggest_cities(city: str, limit: int = 5) -> List[str]:
+    """Подсказки названий городов для опечаток"""
+    return gazetteer.get_gazetteer().suggest(city, limit)
 
 def get_weather_by_coordinates(latitude: float, longitude: float) -> dict:
     url=f"https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={API_KEY}&units=metric"
-    response = requests.get(url)
+    try:
+        response = requests.get(url, timeout=10)
+    except requests.RequestException as e:
+        print(f"Error in get_weather_by_coordinates: {e}")
+        return None
     if response.status_code != 200:
         print(f"Failed to get weather for latitude {latitude} and longitude {longitude}")
         return None
@@ -306,12 +345,195 @@ def print_air_pollution_analysis(analysis_result: Dict) -> None:
     
     print(f"{Fore.CYAN}{'─'*70}{Style.RESET_ALL}\n")
 
-if __name__ == "__main__":
-#    city=input("Введите город: ")
-#    weather = get_hourly_weather(get_coordinates(city))
-#    print(f"Погода в {weather['name']}: {weather['main']['temp']}°C, {weather['weather'][0]['description']}")
+def summarize_weather(weather: dict) -> Dict:
+    """Краткая сводка текущей погоды для пакетной обработки"""
+    main = weather.get("main", {})
+    return {
+        "name": weather.get("name"),
+        "temp": main.get("temp"),
+        "feels_like": main.get("feels_like"),
+        "humidity": main.get("humidity"),
+        "pressure": main.get("pressure"),
+        "wind_speed": (weather.get("wind") or {}).get("speed"),
+        "clouds": (weather.get("clouds") or {}).get("all"),
+        "description": ((weather.get("weather") or [{}])[0]).get("description")
+    }
+
+def _site_coordinates(row: Dict) -> Optional[Tuple[float, float]]:
+    """Координаты из строки входных данных: lat/lon или название города"""
+    lat = row.get("lat", row.get("latitude"))
+    lon = row.get("lon", row.get("longitude", row.get("lng")))
+    if lat not in (None, "") and lon not in (None, ""):
+        return float(lat), float(lon)
+    city = row.get("city") or row.get("name")
+    if city:
+        return get_coordinates(str(city).strip())
+    return None
+
+def analyze_site(row: Dict) -> Dict:
+    """Погода и качество воздуха для одной точки из пакета"""
+    result = {"input": row}
+    try:
+        coordinates = _site_coordinates(row)
+        if not coordinates:
+            result["error"] = "Не удалось определить координаты"
+            return result
+        latitude, longitude = coordinates
+        result["lat"], result["lon"] = latitude, longitude
+        weather = get_weather_by_coordinates(latitude, longitude)
+        result["weather"] = summarize_weather(weather) if weather else None
+        analysis = analyze_air_pollution(get_air_pollution(latitude, longitude))
+        if "error" in analysis:
+            result["air_quality"] = {"error": analysis["error"]}
+        else:
+            result["air_quality"] = {
+                "overall_index": analysis["overall_index"],
+                "overall_status": analysis["overall_status"],
+                "pollutant_indices": analysis["pollutant_indices"]
+            }
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+def iter_sites(stream, fmt: str = "auto") -> Iterator[Tuple[object, Optional[str]]]:
+    """Построчно читает точки из CSV (с заголовком) или JSONL.
+
+    Возвращает пары (строка, ошибка): для некорректной строки ошибка заполнена,
+    а вместо точки отдается исходный текст, чтобы вывод оставался выровнен с вводом.
+    """
+    first = ""
+    for first in stream:
+        if first.strip():
+            break
+    if not first.strip():
+        return
+    lines = itertools.chain([first], stream)
+    if fmt == "auto":
+        fmt = "jsonl" if first.lstrip().startswith("{") else "csv"
+    if fmt == "jsonl":
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line.rstrip("\r\n"), f"Некорректная строка JSON: {e}"
+                continue
+            if not isinstance(row, dict):
+                yield line.rstrip("\r\n"), "Ожидался объект JSON"
+                continue
+            yield row, None
+    else:
+        reader = csv.DictReader(lines)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                yield f"line {reader.line_num}", f"Некорректная строка CSV: {e}"
+                continue
+            yield row, None
+
+def _completed_rows(output_path: str) -> int:
+    """Число полностью записанных строк; обрезает недописанный хвост файла"""
+    if not os.path.exists(output_path):
+        return 0
+    count = 0
+    last_newline = 0
+    with open(output_path, "rb") as f:
+        offset = 0
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            count += chunk.count(b"\n")
+            pos = chunk.rfind(b"\n")
+            if pos != -1:
+                last_newline = offset + pos + 1
+            offset += len(chunk)
+    if last_newline != offset:
+        with open(output_path, "r+b") as f:
+            f.truncate(last_newline)
+    return count
+
+def run_batch(input_path: str = "-", output_path: str = "-", workers: int = 8,
+              fmt: str = "auto", resume: bool = False, progress_interval: float = 5.0) -> int:
+    """Обрабатывает поток точек параллельно и пишет результаты в JSONL в исходном порядке"""
+    if resume and output_path == "-":
+        raise ValueError("--resume requires --output file")
+    skip = _completed_rows(output_path) if resume else 0
+
+    real_stdout = sys.stdout
+    in_file = sys.stdin if input_path == "-" else open(input_path, encoding="utf-8", newline="")
+    out_file = real_stdout if output_path == "-" else open(output_path, "a" if resume else "w", encoding="utf-8")
+    done = 0
+    started = last_report = time.time()
+
+    def report(final: bool = False):
+        elapsed = max(time.time() - started, 1e-9)
+        state = "done" if final else "progress"
+        print(f"[{state}] {done} rows ({skip} skipped), {done / elapsed:.1f} rows/s", file=sys.stderr)
+
+    # отладочные print() из функций API не должны попадать в JSONL
+    with contextlib.redirect_stdout(sys.stderr), ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        try:
+            sites = itertools.islice(iter_sites(in_file, fmt), skip, None)
+            for site, error in sites:
+                if error:
+                    future = Future()
+                    future.set_result({"input": site, "error": error})
+                else:
+                    future = pool.submit(analyze_site, site)
+                pending.append(future)
+                # ограничиваем число точек в памяти, результаты пишем по порядку
+                while len(pending) >= workers * 4 or (pending and pending[0].done()):
+                    out_file.write(json.dumps(pending.popleft().result(), ensure_ascii=False) + "\n")
+                    out_file.flush()
+                    done += 1
+                if time.time() - last_report >= progress_interval:
+                    report()
+                    last_report = time.time()
+            while pending:
+                out_file.write(json.dumps(pending.popleft().result(), ensure_ascii=False) + "\n")
+                out_file.flush()
+                done += 1
+        except KeyboardInterrupt:
+            for future in pending:
+                future.cancel()
+            print(f"Interrupted after {skip + done} rows, rerun with --resume to continue", file=sys.stderr)
+        finally:
+            if in_file is not sys.stdin:
+                in_file.close()
+            if out_file is not real_stdout:
+                out_file.close()
+    report(final=True)
+    return done
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Погода и качество воздуха")
+    subparsers = parser.add_subparsers(dest="command")
+    batch = subparsers.add_parser("batch", help="пакетная обработка точек из CSV/JSONL")
+    batch.add_argument("input", nargs="?", default="-", help="файл с точками (lat,lon или city); '-' - stdin")
+    batch.add_argument("-o", "--output", default="-", help="файл для результатов JSONL; '-' - stdout")
+    batch.add_argument("-w", "--workers", type=int, default=8, help="число параллельных запросов")
+    batch.add_argument("--format", choices=["auto", "csv", "jsonl"], default="auto")
+    batch.add_argument("--resume", action="store_true", help="продолжить прерванный запуск, дописывая в --output")
+    batch.add_argument("--progress-interval", type=float, default=5.0, help="секунд между отчетами о прогрессе")
+    args = parser.parse_args(argv)
+
+    if args.command == "batch":
+        if args.resume and args.output == "-":
+            parser.error("--resume requires --output file")
+        run_batch(args.input, args.output, args.workers, args.format, args.resume, args.progress_interval)
+        return
+
     # Пример использования
     air_pollution_data = get_air_pollution(55.7558, 37.6173)
     if air_pollution_data:
         analysis = analyze_air_pollution(air_pollution_data)
-        print_air_pollution_analysis(analysis)
\ No newline at end of file
+        print_air_pollution_analysis(analysis)
+
+if __name__ == "__main__":
+#    city=input("Введите город: ")
+#    weather = get_hourly_weather(get_coordinates(city))
+#    print(f"Погода в {weather['name']}: {weather['main']['temp']}°C, {weather['weather'][0]['description']}")
+    main()